@@ -1,12 +1,19 @@
-from fastapi import FastAPI, Header, HTTPException
+from fastapi import Depends, FastAPI, File, Header, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
+import asyncio
+import logging
 import os
-import base64
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from PIL import Image
+from PIL import Image, features
 import httpx
 import jwt
+import pybase64
+from cachetools import TTLCache
 from withoutbg import WithoutBG
 
 # Environment variables
@@ -17,167 +24,306 @@ SUPABASE_JWT_SECRET = os.environ.get("SUPABASE_JWT_SECRET")
 if not all([SUPABASE_URL, SUPABASE_SERVICE_KEY, SUPABASE_JWT_SECRET]):
     raise RuntimeError("Missing SUPABASE environment variables")
 
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+log = logging.getLogger("api")
+
+# Upload limits - reject oversized payloads before decoding anything
+MAX_B64_LEN = int(os.environ.get("MAX_UPLOAD_B64", str(20 * 1024 * 1024)))
+MAX_IMAGE_BYTES = (MAX_B64_LEN * 3) // 4
+Image.MAX_IMAGE_PIXELS = 40_000_000
+
 # FastAPI app
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# "*" with allow_credentials=True is rejected by browsers and kept every
+# preflight uncacheable; pin the origins and let preflights cache for a day
+ALLOWED_ORIGINS = [
+    o.strip() for o in os.environ.get("ALLOWED_ORIGINS", "http://localhost:5503").split(",") if o.strip()
+]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-    expose_headers=["*"],
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Authorization", "Content-Type"],
+    expose_headers=["X-Remaining-Credits"],
+    max_age=86400,
 )
 
 # Model
 bg_remover = None
 
+# Decode (CPU-bound, runs in the inference pool). For large JPEGs, draft
+# mode lets libjpeg decode at 1/2-1/8 scale instead of full size then
+# throwing the pixels away.
+MODEL_INPUT_SIZE = (1024, 1024)
+
+def _decode_image(img_data: bytes) -> Image.Image:
+    img = Image.open(BytesIO(img_data))
+    if img.width > MODEL_INPUT_SIZE[0] and img.height > MODEL_INPUT_SIZE[1]:
+        img.draft("RGB", MODEL_INPUT_SIZE)
+    img.load()
+    return img.convert("RGB")
+
+# Inference batching
+# BATCH_WINDOW_MS defaults to 0: with no batched forward in withoutbg the
+# coalescing only amortizes queue/executor overhead, which isn't worth
+# delaying a lone request for. Raise it if a stacked forward ever lands.
+MAX_BATCH = int(os.environ.get("MAX_BATCH", "4"))
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", "0"))
+
+def _run_batch(images):
+    # withoutbg's open-source pipeline has no batched forward, so the
+    # coalesced items share one executor dispatch instead of one each
+    return [bg_remover.remove_background(img) for img in images]
+
+async def _inference_worker():
+    queue = app.state.infer_queue
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await queue.get()]
+        # Only wait for stragglers when a window is configured and the
+        # queue isn't already full enough to dispatch
+        if BATCH_WINDOW_MS > 0 and queue.qsize() < MAX_BATCH - 1:
+            await asyncio.sleep(BATCH_WINDOW_MS / 1000)
+        while len(items) < MAX_BATCH:
+            try:
+                items.append(queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        try:
+            outputs = await loop.run_in_executor(
+                app.state.infer_pool, _run_batch, [img for img, _ in items]
+            )
+        except Exception as exc:
+            for _, fut in items:
+                if not fut.done():
+                    fut.set_exception(exc)
+            continue
+        for (_, fut), output in zip(items, outputs):
+            if not fut.done():
+                fut.set_result(output)
+
+async def _infer(img: Image.Image) -> Image.Image:
+    fut = asyncio.get_running_loop().create_future()
+    await app.state.infer_queue.put((img, fut))
+    return await fut
+
 @app.on_event("startup")
 async def startup_event():
     global bg_remover
-    print("[√] Loading model...")
+    if not features.check("libjpeg_turbo"):
+        log.warning("Pillow is not backed by libjpeg-turbo; JPEG decode will be slow")
+    log.info("Loading model...")
     bg_remover = WithoutBG.opensource()
-    print("[√] Model loaded")
+    log.info("Model loaded")
+    # Single worker so the model is never entered from two threads at once;
+    # keeps inference and encoding off the event loop
+    app.state.infer_pool = ThreadPoolExecutor(max_workers=1)
+    app.state.infer_queue = asyncio.Queue()
+    app.state.infer_task = asyncio.create_task(_inference_worker())
+    # One keep-alive client for all Supabase calls instead of a TCP+TLS
+    # handshake per request
+    app.state.http = httpx.AsyncClient(
+        base_url=SUPABASE_URL,
+        http2=True,
+        timeout=httpx.Timeout(10.0),
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=60),
+        headers={
+            "apikey": SUPABASE_SERVICE_KEY,
+            "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
+            "Accept-Profile": "wondr_users",
+            "Content-Profile": "wondr_users",
+        },
+    )
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await app.state.http.aclose()
+    app.state.infer_task.cancel()
+    app.state.infer_pool.shutdown(wait=False)
 
 # Request model
 class RequestData(BaseModel):
     data_sent: str
+    lossless: bool = False
 
-# Get credits
-async def get_user_credits(user_id: str) -> int:
-    from urllib.parse import quote
-    safe_id = quote(user_id)
-    
-    async with httpx.AsyncClient() as client:
-        res = await client.get(
-            f"{SUPABASE_URL}/rest/v1/wondr_users?select=rembg_credits&UID=eq.{safe_id}",
-            headers={
-                "apikey": SUPABASE_SERVICE_KEY,
-                "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-                "Accept-Profile": "wondr_users",
-            },
-        )
-    
-    if res.status_code != 200:
-        raise HTTPException(status_code=300, detail="Supabase connection failed")
-    
-    data = res.json()
-    if not data:
-        raise HTTPException(status_code=300, detail="User not found")
-    
-    return data[0]["rembg_credits"]
-
-# Deduct credit
+# JWT cache - same bearer token across a session verifies once
+_JWT_CACHE = TTLCache(maxsize=4096, ttl=3600)
+
+def verify_token(token: str) -> dict:
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    payload = _JWT_CACHE.get(key)
+    if payload is not None and payload.get("exp", 0) > time.time():
+        return payload
+    payload = jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=["HS256"], options={"verify_aud": False})
+    _JWT_CACHE[key] = payload
+    return payload
+
+# Deduct credit (atomic UPDATE ... RETURNING, see supabase/functions.sql)
 async def deduct_credit(user_id: str) -> int:
-    current = await get_user_credits(user_id)
-    
-    if current <= 0:
-        raise HTTPException(status_code=400, detail="No credits")
-    
-    new_credits = current - 1
-    
-    from urllib.parse import quote
-    safe_id = quote(user_id)
-    
-    async with httpx.AsyncClient() as client:
-        res = await client.patch(
-            f"{SUPABASE_URL}/rest/v1/wondr_users?UID=eq.{safe_id}",
-            headers={
-                "apikey": SUPABASE_SERVICE_KEY,
-                "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-                "Content-Type": "application/json",
-                "Accept-Profile": "wondr_users",
-                "Content-Profile": "wondr_users",
-            },
-            json={"rembg_credits": new_credits}
-        )
-    
-    if res.status_code not in [200, 204]:
+    res = await app.state.http.post(
+        "/rest/v1/rpc/deduct_rembg_credit",
+        json={"uid": user_id}
+    )
+
+    if res.status_code != 200:
         raise HTTPException(status_code=300, detail="Failed to update credits")
-    
-    return new_credits
 
-# Refund credit
+    remaining = res.json()
+    if remaining is None:
+        raise HTTPException(status_code=403, detail="No credits")
+
+    return remaining
+
+# Refund credit (atomic increment, no read-modify-write)
 async def refund_credit(user_id: str):
     try:
-        current = await get_user_credits(user_id)
-        
-        from urllib.parse import quote
-        safe_id = quote(user_id)
-        
-        async with httpx.AsyncClient() as client:
-            await client.patch(
-                f"{SUPABASE_URL}/rest/v1/wondr_users?UID=eq.{safe_id}",
-                headers={
-                    "apikey": SUPABASE_SERVICE_KEY,
-                    "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-                    "Content-Type": "application/json",
-                    "Accept-Profile": "wondr_users",
-                    "Content-Profile": "wondr_users",
-                },
-                json={"rembg_credits": current + 1}
-            )
+        await app.state.http.post(
+            "/rest/v1/rpc/refund_rembg_credit",
+            json={"uid": user_id}
+        )
     except:
         pass
 
-# Routes
-@app.get("/")
-async def root():
-    return {"status": "running"}
+# Refunds are background work - don't let an already-failed request wait
+# on another Supabase round-trip. The set keeps the tasks referenced
+# until they finish.
+_refund_tasks: set = set()
 
-@app.post("/")
-async def remove_background(request_data: RequestData, authorization: str = Header(None)):
-    user_id = None  # Track user_id for refunds
-    
-    # Auth
+def _refund_in_background(user_id: str):
+    task = asyncio.create_task(refund_credit(user_id))
+    _refund_tasks.add(task)
+    task.add_done_callback(_refund_tasks.discard)
+
+# Encoder speed/size trade-off, overridable per deployment
+WEBP_QUALITY = int(os.environ.get("WEBP_QUALITY", "90"))
+WEBP_METHOD = int(os.environ.get("WEBP_METHOD", "4"))
+
+# Encode (CPU-bound, runs in the inference pool). Returns the buffer
+# itself so callers can stream from it without a bytes copy.
+def _encode_webp(img: Image.Image, lossless: bool = False) -> BytesIO:
+    buffer = BytesIO()
+    if lossless:
+        img.save(buffer, format="WEBP", quality=100, method=6, lossless=True)
+    else:
+        # method=6 + lossless is the slowest encoder path and dominated
+        # post-inference CPU; lossy q90/method=4 is several times faster
+        # for a few percent size difference
+        img.save(buffer, format="WEBP", quality=WEBP_QUALITY, method=WEBP_METHOD)
+    return buffer
+
+# Multiple of 3 so each chunk base64-encodes without mid-stream padding
+_B64_CHUNK = 48 * 1024
+
+def _b64_json_stream(buffer: BytesIO, remaining: int):
+    yield b'{"data_received":"data:image/webp;base64,'
+    with buffer.getbuffer() as view:
+        for pos in range(0, view.nbytes, _B64_CHUNK):
+            yield pybase64.b64encode(view[pos:pos + _B64_CHUNK])
+    yield b'","remaining_credits":' + str(remaining).encode("ascii") + b"}"
+
+# Auth dependency (shared by both upload routes)
+async def get_current_user(authorization: str = Header(None)) -> str:
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=100, detail="Invalid auth")
-    
+
     token = authorization.split(" ")[1]
-    
+
     try:
-        payload = jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=["HS256"], options={"verify_aud": False})
+        payload = verify_token(token)
         user_id = payload.get("sub")
         if not user_id:
             raise HTTPException(status_code=100, detail="Invalid token")
+        return user_id
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=100, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=100, detail="Invalid token")
-    
-    # Decode image FIRST (before deducting credits)
-    try:
-        img_data = base64.b64decode(request_data.data_sent.split(",")[1] if "," in request_data.data_sent else request_data.data_sent)
-        input_img = Image.open(BytesIO(img_data)).convert("RGB")
-    except:
-        raise HTTPException(status_code=500, detail="Invalid image")
-    
-    # Check model is loaded BEFORE deducting credits
+
+# Shared pipeline: deduct + decode overlapped, then infer -> encode,
+# refunding on failure. Returns the buffer holding the WebP bytes and
+# the remaining credits.
+async def _process_image(img_data: bytes, user_id: str, lossless: bool = False) -> tuple[BytesIO, int]:
     if not bg_remover:
         raise HTTPException(status_code=500, detail="Model not loaded")
-    
-    # Credits - only deduct after validation
-    try:
-        remaining = await deduct_credit(user_id)
-    except HTTPException:
-        raise
-    except:
+
+    # Credit deduction and image decode are independent - run the Supabase
+    # round-trip concurrently with the CPU-side decode instead of in series
+    loop = asyncio.get_running_loop()
+    deduct_res, decode_res = await asyncio.gather(
+        deduct_credit(user_id),
+        loop.run_in_executor(app.state.infer_pool, _decode_image, img_data),
+        return_exceptions=True,
+    )
+
+    if isinstance(deduct_res, HTTPException):
+        raise deduct_res
+    if isinstance(deduct_res, BaseException):
         raise HTTPException(status_code=300, detail="Credit error")
-    
-    # Process
+    remaining = deduct_res
+
+    if isinstance(decode_res, BaseException):
+        # The deduction already landed - give the credit back
+        _refund_in_background(user_id)
+        raise HTTPException(status_code=500, detail="Invalid image")
+    input_img = decode_res
+
+    # Process (inference and encode are blocking CPU work - keep them off the loop)
     try:
-        output_img = bg_remover.remove_background(input_img)
-        
-        buffer = BytesIO()
-        output_img.save(buffer, format="WEBP", quality=100, method=6, lossless=True)
-        buffer.seek(0)
-        
-        encoded = base64.b64encode(buffer.getvalue()).decode("utf-8")
-        
-        return {
-            "data_received": f"data:image/webp;base64,{encoded}",
-            "remaining_credits": remaining
-        }
+        output_img = await _infer(input_img)
+        webp_buffer = await loop.run_in_executor(app.state.infer_pool, _encode_webp, output_img, lossless)
+        return webp_buffer, remaining
     except:
-        await refund_credit(user_id)
+        _refund_in_background(user_id)
         raise HTTPException(status_code=500, detail="Processing failed")
+
+# Routes
+@app.get("/")
+async def root():
+    return {"status": "running"}
+
+@app.post("/")
+async def remove_background(request_data: RequestData, user_id: str = Depends(get_current_user)):
+    # Size check before any decoding - a huge base64 blob should cost O(1)
+    if len(request_data.data_sent) > MAX_B64_LEN:
+        raise HTTPException(status_code=413, detail="Payload too large")
+
+    try:
+        raw = request_data.data_sent
+        idx = raw.find(",")  # strip a data-URL prefix without str.split's extra copy
+        img_data = pybase64.b64decode(raw[idx + 1:] if idx >= 0 else raw, validate=False)
+    except:
+        raise HTTPException(status_code=500, detail="Invalid image")
+
+    webp_buffer, remaining = await _process_image(img_data, user_id, request_data.lossless)
+
+    # Base64-encode in chunks straight from the encode buffer into the
+    # response instead of materializing the data URL (or even a bytes copy
+    # of the WebP) in memory
+    return StreamingResponse(
+        _b64_json_stream(webp_buffer, remaining),
+        media_type="application/json"
+    )
+
+@app.post("/v2")
+async def remove_background_v2(file: UploadFile = File(...), lossless: bool = False, user_id: str = Depends(get_current_user)):
+    # Reject on the reported size before pulling the upload into memory;
+    # re-check after the read in case the size was absent or understated
+    if file.size is not None and file.size > MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail="Payload too large")
+
+    img_data = await file.read()
+    if len(img_data) > MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail="Payload too large")
+
+    webp_buffer, remaining = await _process_image(img_data, user_id, lossless)
+    webp_bytes = webp_buffer.getvalue()
+
+    # Raw bytes in, raw bytes out - no base64 inflation in either direction
+    return Response(
+        content=webp_bytes,
+        media_type="image/webp",
+        headers={"X-Remaining-Credits": str(remaining)}
+    )
@@ -0,0 +1,26 @@
+-- Atomic credit operations for the background-removal API.
+-- Run once against the Supabase project (SQL editor or a migration).
+-- Exposed over PostgREST as POST /rest/v1/rpc/<name> with Content-Profile: wondr_users.
+
+create or replace function wondr_users.deduct_rembg_credit(uid text)
+returns int
+language sql
+security definer
+as $$
+    update wondr_users.wondr_users
+       set rembg_credits = rembg_credits - 1
+     where "UID" = uid
+       and rembg_credits > 0
+ returning rembg_credits;
+$$;
+
+create or replace function wondr_users.refund_rembg_credit(uid text)
+returns int
+language sql
+security definer
+as $$
+    update wondr_users.wondr_users
+       set rembg_credits = rembg_credits + 1
+     where "UID" = uid
+ returning rembg_credits;
+$$;